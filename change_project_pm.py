@@ -1,9 +1,11 @@
 import fmrest
+import json
 import requests
+from requests.adapters import HTTPAdapter
 import warnings
 import pandas as pd
-import os
 import sys
+import time
 
 from datetime import datetime
 
@@ -36,6 +38,36 @@ PROJECT_PM_ID_FIELD = "ID_ProjectManager" # Field name for the project manager i
 IDX_FIELD_NAME = "ID_Primary" # custom field name for the primary key used in table relationships
 RECORD_ID_FIELD_NAME = "recordId" # Filemaker official index field name
 
+# Seconds that the recent project manager lookup is reused before being fetched again
+RECENT_PMS_CACHE_TTL = 60
+
+# Server-side FileMaker script that takes n as its parameter, finds the n most recent projects and returns their
+# project managers as a JSON array of {ID_Primary, NameFirst, NameLast} objects
+RECENT_PMS_SCRIPT = "RecentPMs"
+
+# fmrest sends every Data API call through a module-level requests.request call, which opens a new TLS
+# connection each time. Route those calls through one pooled keep-alive session instead.
+FM_SESSION = requests.Session()
+FM_SESSION.verify = False
+FM_SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=0))
+FM_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=0))
+
+
+def _fm_session_request(*args, **kwargs):
+    """
+    Stand-in for fmrest.utils.request that sends the call over FM_SESSION.
+    """
+    timeout = kwargs.pop("timeout", fmrest.const.TIMEOUT)
+    try:
+        return FM_SESSION.request(*args, timeout=timeout, **kwargs)
+    except Exception as ex:
+        raise fmrest.exceptions.RequestException(ex, args, kwargs) from None
+
+
+# install the hook once, leaving it alone if another module already replaced it
+if fmrest.server.request is fmrest.utils.request:
+    fmrest.server.request = _fm_session_request
+
 def dataframe_to_rich_table(df: pd.DataFrame, include_index: bool = True, 
                             row1_style: str = "deep_sky_blue4", row2_style: str = "grey74") -> Table:
     table = Table(show_lines=True)  # Add horizontal lines between rows
@@ -47,23 +79,32 @@ def dataframe_to_rich_table(df: pd.DataFrame, include_index: bool = True,
         table.add_column(column)
     
     # Add rows with alternating styles
-    for idx, row in df.iterrows():
-        row_values = []
-        if include_index:
-            row_values.append(str(idx))
-        row_values.extend([str(row[column]) for column in df.columns])
+    add_row = table.add_row
+    for idx, *values in df.itertuples(index=True, name=None):
+        row_values = [str(idx)] if include_index else []
+        row_values.extend(map(str, values))
         
         # Apply alternating row styles
         row_style = row1_style if idx % 2 == 0 else row2_style
-        table.add_row(*row_values, style=row_style)
+        add_row(*row_values, style=row_style)
     
     return table
 
 class ProjectChangingClerk:
+    # shared session for the connectivity probes so repeated failures reuse pooled sockets
+    _probe_session = requests.Session()
+    _probe_session.verify = False
+    _probe_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    _probe_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
     def __init__(self, url, db_name = DATABASE_NAME, username = FILEMAKER_USERNAME, password = FILEMAKER_PASSWORD):
         self.default_layout = PROJECTS_LAYOUT
         self.auto_login_attempts = 3
         self.fm_url = url
+        # lookup caches to avoid repeating the same FileMaker requests within a session
+        self._pm_cache = {} # pm id -> people record
+        self._recent_pms_cache = {} # n -> (fetch time, recent pm dataframe)
+        self._recent_pms_script_available = True # set False once RECENT_PMS_SCRIPT fails so it is not retried
         self.fm_server = fmrest.Server(url,
                                        database=db_name,
                                        layout=self.default_layout,
@@ -77,38 +118,48 @@ class ProjectChangingClerk:
         except Exception as e:
             # test url visibility
             try:
-                requests.get(url, verify=False)
-            except requests.exceptions.ConnectionError:
+                self._probe_session.get(url, timeout=3)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                 # test internet connection
                 try:
-                    requests.get("https://www.google.com")
-                except requests.exceptions.ConnectionError:
+                    self._probe_session.get("https://www.google.com", verify=True, timeout=3)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                     raise ValueError("No internet connection available?")
                 
                 raise ValueError("Could not connect to the FileMaker server at {}".format(url))
             
 
     def _auto_relogin_fm(self, server_method, *args, **kwargs):
+        """
+        Calls server_method, logging back in and retrying (up to auto_login_attempts) when the session token
+        has expired (952). Returns None when FileMaker reports no matching records (401); other errors are raised.
+        """
         attempted = 0
         while True:
             try:
                 return server_method(*args, **kwargs)
             except Exception as e:
-                attempted += 1
-                if attempted >= self.auto_login_attempts:
-                    raise e
-                if '952' in str(e):
-                    self.fm_server.login()
-                
-                if '401' in str(e):
+                msg = str(e)
+                if '401' in msg:
                     warnings.warn("FileMaker Server returned error 401, No records match the request")
                     return None
-                else:
-                    raise e
 
-    def projects_queried_by_number_df(self, number):
+                attempted += 1
+                if '952' in msg and attempted < self.auto_login_attempts:
+                    self.fm_server.login()
+                    continue
+                raise
+
+    def projects_queried_by_number_iter(self, number):
+        """
+        Returns the raw foundset of projects matching the number (or None if there are none), for callers
+        that only need a field or two and can skip building a DataFrame.
+        """
         project_number_query = [{PROJECT_NUMBER_FIELD: str(number)}]
-        project_foundset = self._auto_relogin_fm(self.fm_server.find, query=project_number_query)
+        return self._auto_relogin_fm(self.fm_server.find, query=project_number_query)
+
+    def projects_queried_by_number_df(self, number):
+        project_foundset = self.projects_queried_by_number_iter(number)
         if not project_foundset:
             return pd.DataFrame()
         
@@ -121,10 +172,36 @@ class ProjectChangingClerk:
             return None
         return project_foundset[0]
     
-    def get_most_recent_pms(self, n):
+    def _recent_pms_from_script(self, n):
         """
-        Retrieves the n most recent projects (by database idx) to get the most recent project managers.
-        Returns a list of sets of project manager names and project manager ids.
+        Gets the project managers of the n most recent projects in one round-trip using RECENT_PMS_SCRIPT.
+        Returns None if the script is not available on the server, its result is empty or missing fields, or the
+        request fails in transit.
+        """
+        try:
+            script_response = self._auto_relogin_fm(self.fm_server.perform_script, name=RECENT_PMS_SCRIPT, param=str(n))
+            script_error, script_result = script_response if script_response else (None, None)
+            if script_error or not script_result:
+                raise ValueError("FileMaker script {} returned error {}".format(RECENT_PMS_SCRIPT, script_error))
+            recent_pm_df = pd.DataFrame(json.loads(script_result))
+            required_cols = [IDX_FIELD_NAME, PEOPLE_FIRST_NAME_FIELD, PEOPLE_LAST_NAME_FIELD]
+            if recent_pm_df.empty or not set(required_cols).issubset(recent_pm_df.columns):
+                raise ValueError("FileMaker script {} returned no usable project managers".format(RECENT_PMS_SCRIPT))
+            return recent_pm_df
+
+        except (fmrest.exceptions.FileMakerError, ValueError):
+            # the script is missing, failing or returning an unusable payload; stop trying it this session
+            self._recent_pms_script_available = False
+            return None
+
+        except fmrest.exceptions.FMRestException:
+            # transport or response hiccup (timeout, connection drop, bad JSON); fall back for this call only
+            return None
+
+    def _recent_pms_from_finds(self, n):
+        """
+        Gets the project managers of the n most recent projects with a find on the projects layout followed by
+        a find on the people layout.
         """
         sort_specs = [{'fieldName': IDX_FIELD_NAME, 'sortOrder': 'descend'}]
         retrieved_project_set = self._auto_relogin_fm(self.fm_server.get_records, limit=n, sort=sort_specs)
@@ -137,17 +214,41 @@ class ProjectChangingClerk:
         recent_pm_df = recent_pm_foundset.to_df()
 
         # for any set of rows with the same ID_Primary, keep only the active row (1 in PEOPLE_ACTIVE_FIELD)
-        recent_pm_df = recent_pm_df.sort_values([IDX_FIELD_NAME, PEOPLE_ACTIVE_FIELD], ascending=[True, False]).drop_duplicates(subset=IDX_FIELD_NAME)
+        # (active flag coerced to numbers so blank values count as inactive)
+        active_flags = pd.to_numeric(recent_pm_df[PEOPLE_ACTIVE_FIELD], errors="coerce").fillna(0)
+        active_idx = active_flags.groupby(recent_pm_df[IDX_FIELD_NAME], sort=False).idxmax()
+        recent_pm_df = recent_pm_df.loc[active_idx]
+        return recent_pm_df
+
+    def get_most_recent_pms(self, n):
+        """
+        Retrieves the n most recent projects (by database idx) to get the most recent project managers.
+        Returns a list of sets of project manager names and project manager ids.
+        Results are reused for RECENT_PMS_CACHE_TTL seconds.
+        """
+        cached = self._recent_pms_cache.get(n)
+        if cached and time.monotonic() - cached[0] < RECENT_PMS_CACHE_TTL:
+            return cached[1].copy()
 
-        return recent_pm_df[[IDX_FIELD_NAME, PEOPLE_FIRST_NAME_FIELD, PEOPLE_LAST_NAME_FIELD]]
+        recent_pm_df = self._recent_pms_from_script(n) if self._recent_pms_script_available else None
+        if recent_pm_df is None:
+            recent_pm_df = self._recent_pms_from_finds(n)
+
+        recent_pm_df = recent_pm_df[[IDX_FIELD_NAME, PEOPLE_FIRST_NAME_FIELD, PEOPLE_LAST_NAME_FIELD]]
+        self._recent_pms_cache[n] = (time.monotonic(), recent_pm_df)
+        return recent_pm_df.copy()
     
     def get_pm_by_id(self, pm_id):
+        if str(pm_id) in self._pm_cache:
+            return self._pm_cache[str(pm_id)]
+
         pm_query = [{IDX_FIELD_NAME: pm_id}]
         pm_foundset = self._auto_relogin_fm(self.fm_server.find, query=pm_query, request_layout=PEOPLE_LAYOUT)
         if not pm_foundset:
             raise ValueError("No project manager found with the id {}".format(pm_id))
         
         pm = pm_foundset[0]
+        self._pm_cache[str(pm_id)] = pm
         return pm
 
     def get_project_pm(self, project_number = "", project_idx = ""):
@@ -157,14 +258,15 @@ class ProjectChangingClerk:
         
         pm_idx = None
         if project_number:
-            projects_foundset_df = self.projects_queried_by_number_df(project_number)
-            if projects_foundset_df.empty:
+            projects_foundset = self.projects_queried_by_number_iter(project_number)
+            project_pm_ids = [record[PROJECT_PM_ID_FIELD] for record in projects_foundset] if projects_foundset else []
+            if not project_pm_ids:
                 return None
             
-            if len(projects_foundset_df) > 1:
+            if len(project_pm_ids) > 1:
                 raise ValueError("Multiple projects found with the same project number{}".format(project_number))
             
-            pm_idx = projects_foundset_df[PROJECT_PM_ID_FIELD].iloc[0]
+            pm_idx = project_pm_ids[0]
         
         else:
             project_query = [{IDX_FIELD_NAME: str(project_idx)}]
@@ -182,13 +284,18 @@ class ProjectChangingClerk:
 
     
 class PmChangeService:
-    def __init__(self, url):
-        self.clerk = ProjectChangingClerk(url)
+    def __init__(self, url, clerk=None):
+        # pass in an existing clerk to reuse its FileMaker session and lookup caches
+        self.clerk = clerk if clerk else ProjectChangingClerk(url)
         self.project_to_change = None
         self.target_pm = None
         self.console = Console()
         # adjust this number to change the number of projects to look back for project managers
         self.project_lookback_num = 100
+        # styled text reused across prompts and invalid input retries
+        self._invalid_idx_text = Text("Invalid index. Please enter a valid index.", style="bold red")
+        self._exit_text = Text("\nExiting program", style="bold red")
+        self._prompt_texts = {} # prompt string -> styled prompt text
 
     def introduction(self):
         intro_text = Text(f"This service allows you to change the project manager of a project to one of the PMs used in the previous {self.project_lookback_num} projects. Use ctrl-c to exit at any time.", style="bold blue")
@@ -196,10 +303,12 @@ class PmChangeService:
 
     def _ask(self, prompt_str):
         try:
-            prompt_text = Text(prompt_str, style="bold yellow")
+            prompt_text = self._prompt_texts.get(prompt_str)
+            if prompt_text is None:
+                prompt_text = self._prompt_texts[prompt_str] = Text(prompt_str, style="bold yellow")
             return Prompt.ask(prompt_text, console=self.console)
         except KeyboardInterrupt:
-            self.console.print("\nExiting program", style="bold red")
+            self.console.print(self._exit_text)
             sys.exit()
     
     def _generate_notes_str(self, old_pm_name, new_pm_name):
@@ -258,7 +367,7 @@ class PmChangeService:
                 
                 # if the entered index is not a valid index of the foundset dataframe, ask the user to enter a valid index
                 if not (user_table_idx.isdigit() and int(user_table_idx) in user_table_df.index):
-                    self.console.print("Invalid index. Please enter a valid index.", style="bold red")
+                    self.console.print(self._invalid_idx_text)
                     continue
                 project_idx = user_table_df.loc[int(user_table_idx), IDX_FIELD_NAME]
         else:
@@ -284,7 +393,7 @@ class PmChangeService:
         while pm_idx not in pm_choices_df[IDX_FIELD_NAME].astype(str).values:
             pm_idx = self._ask("Enter the id (ID_primary) of the new project manager")
             if pm_idx not in pm_choices_df[IDX_FIELD_NAME].astype(str).values:
-                print("Invalid index. Please enter a valid index.")
+                self.console.print(self._invalid_idx_text)
         pm = self.clerk.get_pm_by_id(pm_idx)
         self.target_pm = pm
         self.console.clear()
@@ -309,9 +418,9 @@ class PmChangeService:
         
         if not self.target_pm:
             # border terminal clear operations to prevent overlap
-            os.system("cls" if os.name == "nt" else "clear")
+            self.console.clear()
             self.elicit_new_pm()
-            os.system("cls" if os.name == "nt" else "clear")
+            self.console.clear()
         
         proj_notes = self.project_to_change[PROJECT_NOTES_FIELD]
         target_pm_name = f"{self.target_pm[PEOPLE_FIRST_NAME_FIELD]} {self.target_pm[PEOPLE_LAST_NAME_FIELD]}"
@@ -329,10 +438,12 @@ class PmChangeService:
 
 
 if __name__ == "__main__":
+    clerk = None
     while True:
         #fmp_server_url = r'https://pp-prd-fm-2.au.ucsc.edu/'
         fmp_server_url = r'https://pp-dev-fm-1.au.ucsc.edu/'
-        service = PmChangeService(fmp_server_url)
+        service = PmChangeService(fmp_server_url, clerk=clerk)
+        clerk = service.clerk
         service.introduction()
         service.change_project_pm()
 
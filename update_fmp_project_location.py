@@ -1,12 +1,19 @@
+import copy
 import fmrest
+import json
 import logging
 import os
 import psycopg2
+import psycopg2.pool
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import warnings
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote_plus, urlencode
 from creds import FILEMAKER_USERNAME, FILEMAKER_PASSWORD, DB_ACCOUNT_USERNAME, DB_ACCOUNT_PASSWORD
 
 # Suppress SSL verification warnings
@@ -21,6 +28,23 @@ RECORD_ID_FIELD_NAME = "recordId" # Filemaker official index field name
 PROJECT_NUMBER_FIELD = "ProjectNumber"
 PROJECT_LOCATION_FIELD = "FileServerLocation"
 
+# Server-side FileMaker script that finds each project by number and sets its location.
+# Its parameter is a JSON array of {"n": project number, "loc": location} objects and it returns
+# a JSON object of project number lists keyed by outcome: "updated", "not_found" and "multiple".
+LOCATION_UPDATE_SCRIPT = "UpdateLocationByNumber"
+LOCATION_UPDATE_BATCH_SIZE = 100 # max number of projects sent per script call
+# perform_script sends its parameter in the GET query string, so batches are also capped by the url-encoded
+# parameter length to stay under the web server's query string limit (2048 by default on IIS)
+LOCATION_UPDATE_MAX_PARAM_LENGTH = 2000
+LOCATION_UPDATE_SCRIPT_TIMEOUT = 120 # seconds to wait for a batch; the fmrest default of 10 is too short
+MAX_CONCURRENT_UPDATES = 8 # per-project updates in flight at once when the script is unavailable
+
+# Outcomes of a single project location update. The first three match the LOCATION_UPDATE_SCRIPT payload keys.
+LOCATION_UPDATED = "updated"
+PROJECT_NOT_IN_FMP = "not_found"
+MULTIPLE_PROJECTS_IN_FMP = "multiple"
+UPDATE_FAILED = "failed"
+
 
 DB_CONN_PARAMS = {
     'dbname': 'archives',
@@ -32,6 +56,9 @@ DB_CONN_PARAMS = {
     #'sslrootcert': root_cert_filepath
 }
 
+# Postgres connection pools keyed by connection parameters. Created on first use so importing this module doesn't connect.
+_PG_POOLS = {}
+
 # Create a custom logger
 logger = logging.getLogger(__name__)
 
@@ -60,6 +87,10 @@ def setup_logger(log_to_file=False):
 
 setup_logger(log_to_file=True)
 
+# Patterns used by split_path to tell Windows and Linux paths apart
+_WIN_RE = re.compile(r"^[A-Za-z]:\\(.+)$")
+_LNX_RE = re.compile(r"^/([^/]+/)*[^/]+$")
+
 
 def split_path(path):
     """
@@ -74,12 +105,9 @@ def split_path(path):
         :param filepath: The filepath to detect.
         :return: The OS of the filepath. (Windows, Linux, or Unknown)
         """
-        windows_pattern = r"^[A-Za-z]:\\(.+)$"
-        linux_pattern = r"^/([^/]+/)*[^/]+$"
-
-        if re.match(windows_pattern, filepath):
+        if _WIN_RE.match(filepath):
             return "Windows"
-        elif re.match(linux_pattern, filepath):
+        elif _LNX_RE.match(filepath):
             return "Linux"
         else:
             return "Unknown"
@@ -87,7 +115,6 @@ def split_path(path):
     def split_windows_path(filepath):
         """"""
         parts = []
-        curr_part = ""
         is_absolute = False
 
         if filepath.startswith("\\\\"):
@@ -100,20 +127,11 @@ def split_path(path):
             filepath = filepath[2:]
             is_absolute = True
 
-        for char in filepath:
-            if (char == "\\"):
-                if curr_part:
-                    parts.append(curr_part)
-                    curr_part = ""
-            else:
-                curr_part += char
-
-        if curr_part:
-            parts.append(curr_part)
+        parts.extend(part for part in filepath.split("\\") if part)
 
         if not is_absolute and not parts:
             # Relative path with a single directory or filename
-            parts.append(curr_part)
+            parts.append("")
 
         return parts
     
@@ -150,81 +168,153 @@ def db_path_to_user_path(db_path):
     return os.path.join(*path_list)
 
 
+# fmrest sends every Data API call through a module-level requests.request call, which opens a new TLS
+# connection each time. Route those calls through one pooled keep-alive session instead.
+FM_SESSION = requests.Session()
+FM_SESSION.verify = False
+FM_SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=0))
+FM_SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=0))
+
+
+def _fm_session_request(*args, **kwargs):
+    """
+    Stand-in for fmrest.utils.request that sends the call over FM_SESSION.
+    """
+    timeout = kwargs.pop("timeout", fmrest.const.TIMEOUT)
+    try:
+        return FM_SESSION.request(*args, timeout=timeout, **kwargs)
+    except Exception as ex:
+        raise fmrest.exceptions.RequestException(ex, args, kwargs) from None
+
+
+# install the hook once, leaving it alone if another module already replaced it
+if fmrest.server.request is fmrest.utils.request:
+    fmrest.server.request = _fm_session_request
+
+
+def get_pg_pool(conn_params=DB_CONN_PARAMS):
+    """
+    Returns the connection pool for the given connection parameters, creating it on first use.
+    """
+    pool_key = tuple(sorted(conn_params.items()))
+    if pool_key not in _PG_POOLS:
+        _PG_POOLS[pool_key] = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=4, **conn_params)
+    return _PG_POOLS[pool_key]
+
+
 def retrieve_project_location_df(conn_params=DB_CONN_PARAMS):
     """
     Retrieve the project location data from the database.
     """
-    # select all projects with a value in the location field
-    q = """
-    SELECT *
+    # select the number and location of all projects with a value in the location field
+    columns = ['number', 'file_server_location']
+    q = f"""
+    SELECT {', '.join(columns)}
     FROM projects
     WHERE file_server_location IS NOT NULL
     """
     
-    with psycopg2.connect(**conn_params) as conn:
-        with conn.cursor() as cur:
-            cur.execute(q)
-            return pd.DataFrame(cur.fetchall(), columns=[desc[0] for desc in cur.description])
+    pg_pool = get_pg_pool(conn_params)
+    conn = pg_pool.getconn()
+    try:
+        # the connection context only ends the transaction; the connection itself goes back to the pool
+        with conn:
+            # named (server-side) cursor streams rows in batches of itersize instead of one fetchall
+            with conn.cursor(name='projloc') as cur:
+                cur.itersize = 1000
+                cur.execute(q)
+                return pd.DataFrame.from_records(cur, columns=columns)
+    finally:
+        pg_pool.putconn(conn)
 
 
 
 class ProjectChangingClerk:
+    # shared session for the connectivity probes so repeated failures reuse pooled sockets
+    _probe_session = requests.Session()
+    _probe_session.verify = False
+    _probe_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    _probe_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
     def __init__(self, url, db_name = DATABASE_NAME, username = FILEMAKER_USERNAME, password = FILEMAKER_PASSWORD):
         self.default_layout = PROJECTS_LAYOUT
         self.auto_login_attempts = 3
         self.fm_url = url
-        self.fm_server = fmrest.Server(url,
-                                       database=db_name,
-                                       layout=self.default_layout,
-                                       user=username,
-                                       password=password,
-                                       api_version='v1',
-                                       verify_ssl=False)
+        # serializes re-logins across this clerk and its worker clerks, which all share this clerk's token
+        self._relogin_lock = threading.Lock()
+        self._token_owner = self
+        self._fm_server_params = {'database': db_name,
+                                  'layout': self.default_layout,
+                                  'user': username,
+                                  'password': password,
+                                  'api_version': 'v1',
+                                  'verify_ssl': False}
+        self.fm_server = fmrest.Server(url, **self._fm_server_params)
         try: 
             self.fm_server.login()
             
         except Exception as e:
             # test url visibility
             try:
-                requests.get(url, verify=False)
-            except requests.exceptions.ConnectionError:
+                self._probe_session.get(url, timeout=3)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                 # test internet connection
                 try:
-                    requests.get("https://www.google.com")
-                except requests.exceptions.ConnectionError:
+                    self._probe_session.get("https://www.google.com", verify=True, timeout=3)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                     raise ValueError("No internet connection available?")
                 
                 raise ValueError("Could not connect to the FileMaker server at {}".format(url))
             
 
+    def worker_clerk(self):
+        """
+        Returns a clerk for use on a worker thread. fmrest.Server keeps per-call error and header state, so it
+        is not thread-safe; the worker gets its own Server but reuses this clerk's login token.
+        """
+        worker = copy.copy(self)
+        worker.fm_server = fmrest.Server(self.fm_url, **self._fm_server_params)
+        worker.fm_server._token = self.fm_server._token
+        return worker
+
+    def _refresh_fm_token(self, expired_token):
+        """
+        Logs back in after a 952 and picks up the new token. If another thread already refreshed the shared
+        token while this one waited on the lock, the new token is reused instead of opening another session.
+        """
+        with self._relogin_lock:
+            owner_server = self._token_owner.fm_server
+            if owner_server._token == expired_token:
+                owner_server.login()
+            self.fm_server._token = owner_server._token
+
     def _auto_relogin_fm(self, server_method, *args, **kwargs):
+        """
+        Calls server_method, logging back in and retrying (up to auto_login_attempts) when the session token
+        has expired (952). Returns None when FileMaker reports no matching records (401); other errors are raised.
+        """
         attempted = 0
         while True:
+            used_token = self.fm_server._token
             try:
                 return server_method(*args, **kwargs)
             except Exception as e:
-                attempted += 1
-                if attempted >= self.auto_login_attempts:
-                    raise e
-                if '952' in str(e):
-                    self.fm_server.login()
-                
-                if '401' in str(e):
+                msg = str(e)
+                if '401' in msg:
                     warnings.warn("FileMaker Server returned error 401, No records match the request")
                     return None
-                else:
-                    raise e
+
+                attempted += 1
+                if '952' in msg and attempted < self.auto_login_attempts:
+                    self._refresh_fm_token(used_token)
+                    continue
+                raise
                 
     def projects_queried_by_number(self, number):
         project_number_query = [{PROJECT_NUMBER_FIELD: str(number)}]
         project_foundset = self._auto_relogin_fm(self.fm_server.find, query=project_number_query)
         return project_foundset
     
-    def projects_queried_by_id(self, project_id):
-        project_id_query = [{IDX_FIELD_NAME: str(project_id)}]
-        project_foundset = self._auto_relogin_fm(self.fm_server.find, query=project_id_query)
-        return project_foundset
-    
     def update_record(self, record):
         update_result = self._auto_relogin_fm(self.fm_server.edit, record=record)
         return update_result
@@ -233,16 +323,86 @@ class ProjectChangingClerk:
         edit_results = self._auto_relogin_fm(self.fm_server.edit_record, record_id=project_record_id, field_data=change_dict)
         return edit_results
 
+    def update_locations_by_script(self, location_updates):
+        """
+        Sends a batch of project locations to LOCATION_UPDATE_SCRIPT so the find and edit for every
+        project happen server-side in a single round-trip.
+        :param location_updates: list of (project number, location) tuples.
+        :return: dict of project number (str) lists keyed by outcome.
+        """
+        script_param = json.dumps([location_update_param(number, location) for number, location in location_updates])
+        default_timeout = self.fm_server.timeout
+        self.fm_server.timeout = LOCATION_UPDATE_SCRIPT_TIMEOUT
+        try:
+            script_response = self._auto_relogin_fm(self.fm_server.perform_script, name=LOCATION_UPDATE_SCRIPT, param=script_param)
+        finally:
+            self.fm_server.timeout = default_timeout
+
+        # a batch always reports an outcome for its projects, so an empty response means the script did not run
+        if not script_response:
+            raise ValueError(f"FileMaker script {LOCATION_UPDATE_SCRIPT} returned no response")
+
+        script_error, script_result = script_response
+        if script_error:
+            raise ValueError(f"FileMaker script {LOCATION_UPDATE_SCRIPT} returned error {script_error}")
+        script_result = json.loads(script_result) if script_result else None
+        if not isinstance(script_result, dict) or not script_result:
+            raise ValueError(f"FileMaker script {LOCATION_UPDATE_SCRIPT} returned no outcomes")
+
+        outcomes = (LOCATION_UPDATED, PROJECT_NOT_IN_FMP, MULTIPLE_PROJECTS_IN_FMP)
+        if any(not isinstance(script_result.get(outcome, []), list) for outcome in outcomes):
+            raise ValueError(f"FileMaker script {LOCATION_UPDATE_SCRIPT} returned malformed outcomes: {script_result}")
+        # project numbers normalized to str to match the numbers sent in the batch
+        return {outcome: [str(number) for number in script_result.get(outcome, [])] for outcome in outcomes}
+
+
+def location_update_param(number, location):
+    """
+    Builds the LOCATION_UPDATE_SCRIPT parameter entry for one project.
+    """
+    return {"n": number, "loc": location}
+
+
+def batch_location_updates(location_updates, max_batch_size=LOCATION_UPDATE_BATCH_SIZE,
+                           max_param_length=LOCATION_UPDATE_MAX_PARAM_LENGTH):
+    """
+    Splits (project number, location) pairs into batches for LOCATION_UPDATE_SCRIPT, each holding at most
+    max_batch_size projects and (unless a single project is longer) at most max_param_length url-encoded
+    characters of script parameter.
+    """
+    empty_length = len(urlencode({"script.param": "[]"}))
+    separator_length = len(quote_plus(", "))
+    batches = []
+    batch, batch_length = [], empty_length
+    for number, location in location_updates:
+        entry_length = len(quote_plus(json.dumps(location_update_param(number, location)))) + separator_length
+        if batch and (len(batch) >= max_batch_size or batch_length + entry_length > max_param_length):
+            batches.append(batch)
+            batch, batch_length = [], empty_length
+        batch.append((number, location))
+        batch_length += entry_length
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def unreported_location_updates(location_updates, script_result):
+    """
+    Returns the (project number, location) pairs of a batch that LOCATION_UPDATE_SCRIPT left out of every outcome list.
+    """
+    reported_numbers = {number for numbers in script_result.values() for number in numbers}
+    return [(number, location) for number, location in location_updates if str(number) not in reported_numbers]
+
 
 class UpdateStatus:
-    __attrs__ = ['project_locations_updated', 'projects_not_in_fmp', 'projects_not_in_db', 'multiple_projects_in_fmp', 'ids_not_found_in_fmp', 'projects_modified']
+    __attrs__ = ['project_locations_updated', 'projects_not_in_fmp', 'projects_not_in_db', 'multiple_projects_in_fmp', 'projects_modified']
 
     def __init__(self):
         self.project_locations_updated = 0
         self.projects_not_in_fmp = 0
         self.projects_not_in_db = 0
         self.multiple_projects_in_fmp = 0
-        self.ids_not_found_in_fmp = 0
         # put project numbers in this list
         self.projects_modified = []
     
@@ -250,10 +410,87 @@ class UpdateStatus:
         return f"Project Locations Updated: {self.project_locations_updated}\n" + \
                f"Projects Not Found in FileMaker: {self.projects_not_in_fmp}\n" + \
                f"Projects Not Found in Database: {self.projects_not_in_db}\n" + \
-               f"Multiple Projects Found in FileMaker: {self.multiple_projects_in_fmp}\n" + \
-               f"IDs Not Found in FileMaker: {self.ids_not_found_in_fmp}\n"
-    
+               f"Multiple Projects Found in FileMaker: {self.multiple_projects_in_fmp}\n"
 
+    def record_outcome(self, proj_number, outcome):
+        """
+        Tallies the outcome of updating a single project.
+        """
+        if outcome == LOCATION_UPDATED:
+            self.project_locations_updated += 1
+            self.projects_modified.append(proj_number)
+        elif outcome == PROJECT_NOT_IN_FMP:
+            self.projects_not_in_fmp += 1
+        elif outcome == MULTIPLE_PROJECTS_IN_FMP:
+            self.multiple_projects_in_fmp += 1
+
+    def record_script_result(self, script_result):
+        """
+        Tallies the outcome payload returned by LOCATION_UPDATE_SCRIPT.
+        """
+        for proj_number in script_result.get(PROJECT_NOT_IN_FMP, []):
+            logger.warning(f"Project {proj_number} not found in FileMaker.")
+        for proj_number in script_result.get(MULTIPLE_PROJECTS_IN_FMP, []):
+            logger.warning(f"Multiple projects found in FileMaker for project number {proj_number}.")
+        for outcome in (LOCATION_UPDATED, PROJECT_NOT_IN_FMP, MULTIPLE_PROJECTS_IN_FMP):
+            for proj_number in script_result.get(outcome, []):
+                self.record_outcome(proj_number, outcome)
+
+
+def update_project_location(clerk, proj_number, user_location):
+    """
+    Finds a single project in FileMaker by number and sets its location field. Used when the
+    LOCATION_UPDATE_SCRIPT is not available on the server.
+    :return: The outcome of the update, one of the outcome constants.
+    """
+    try:
+        fmp_proj_num_foundset = clerk.projects_queried_by_number(proj_number)
+        if not fmp_proj_num_foundset:
+            logger.warning(f"Project {proj_number} not found in FileMaker.")
+            return PROJECT_NOT_IN_FMP
+
+        # get the records exactly matching the (already stripped) project number
+        fmp_proj_num_rows = [record for record in fmp_proj_num_foundset if str(record[PROJECT_NUMBER_FIELD]).strip() == proj_number]
+        if not fmp_proj_num_rows:
+            logger.warning(f"Project {proj_number} not found in FileMaker.")
+            return PROJECT_NOT_IN_FMP
+        
+        if len(fmp_proj_num_rows) > 1:
+            logger.warning(f"Multiple projects found in FileMaker for project number {proj_number}.")
+            return MULTIPLE_PROJECTS_IN_FMP
+
+        # the number foundset already carries the FileMaker record id of the matching project
+        record_id = fmp_proj_num_rows[0][RECORD_ID_FIELD_NAME]
+        change_dict = {PROJECT_LOCATION_FIELD: user_location}
+        updated = clerk.make_change_to_project_data(record_id, change_dict)
+        if updated:
+            return LOCATION_UPDATED
+
+        logger.warning(f"FileMaker did not confirm the location update for project {proj_number}.")
+        return UPDATE_FAILED
+
+    except Exception as e:
+        logger.error(f"Error processing project {proj_number}: {e}")
+        return UPDATE_FAILED
+
+
+def update_project_locations_concurrently(clerk, status, location_updates, max_workers=MAX_CONCURRENT_UPDATES):
+    """
+    Runs update_project_location for every (project number, location) pair on a thread pool, keeping up to
+    max_workers requests to FileMaker in flight at once. Each worker thread uses its own worker clerk, and
+    outcomes are tallied on the calling thread.
+    """
+    worker_state = threading.local()
+
+    def process_row(location_update):
+        if not hasattr(worker_state, "clerk"):
+            worker_state.clerk = clerk.worker_clerk()
+        proj_number, user_location = location_update
+        return proj_number, update_project_location(worker_state.clerk, proj_number, user_location)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for proj_number, outcome in executor.map(process_row, location_updates):
+            status.record_outcome(proj_number, outcome)
 
 
 if __name__ == "__main__":
@@ -263,54 +500,36 @@ if __name__ == "__main__":
     status = UpdateStatus()
     project_location_df = retrieve_project_location_df()
 
-    for idx, row in project_location_df.iterrows():
-        try:
-            proj_number = row['number']
-            proj_db_location = row['file_server_location']
-            fmp_proj_num_foundset = clerk.projects_queried_by_number(proj_number)
-            if not fmp_proj_num_foundset:
-                logger.warning(f"Project {proj_number} not found in FileMaker.")
-                status.projects_not_in_fmp += 1
-                continue
-
-            # turn foundset into df, get the row exactly matching the project number
-            fmp_proj_num_df = fmp_proj_num_foundset.to_df()
-            # PROJECT_NUMBER_FIELD column cast to string and stripped of whitespace
-            fmp_proj_num_df[PROJECT_NUMBER_FIELD] = fmp_proj_num_df[PROJECT_NUMBER_FIELD].astype(str).str.strip()
-            fmp_proj_num_row = fmp_proj_num_df[fmp_proj_num_df[PROJECT_NUMBER_FIELD] == proj_number]
-            if fmp_proj_num_row.empty:
-                logger.warning(f"Project {proj_number} not found in FileMaker.")
-                status.projects_not_in_fmp += 1
-                continue
-            
-            if len(fmp_proj_num_row) > 1:
-                logger.warning(f"Multiple projects found in FileMaker for project number {proj_number}.")
-                status.multiple_projects_in_fmp += 1
-                continue
-
-            # get the project id from the row
-            proj_id = fmp_proj_num_row[IDX_FIELD_NAME].iloc[0]
-            fmp_proj_id_foundset = clerk.projects_queried_by_id(proj_id)
-            
-            # check only one project was found
-            if not fmp_proj_id_foundset or len(fmp_proj_id_foundset.to_df()) > 1:
-                logger.warning(f"Project {proj_number} not found in FileMaker using ID, {proj_id}.")
-                status.ids_not_found_in_fmp += 1
-                continue
-            
-            user_location = db_path_to_user_path(proj_db_location)
-            for record in fmp_proj_id_foundset:
-                record_id = record[RECORD_ID_FIELD_NAME]
-                change_dict = {PROJECT_LOCATION_FIELD: user_location}
-                updated = clerk.make_change_to_project_data(record_id, change_dict)
-                if updated:
-                    status.project_locations_updated += 1
-                    status.projects_modified.append(proj_number)
-                break
+    # normalize the project numbers once, then walk plain (number, location) tuples instead of pandas rows
+    project_location_df['number'] = project_location_df['number'].astype(str).str.strip()
+    rows = list(zip(project_location_df['number'].to_numpy(), project_location_df['file_server_location'].to_numpy()))
 
+    # build the list of (project number, user location) pairs to send to FileMaker
+    location_updates = []
+    for proj_number, proj_db_location in rows:
+        try:
+            location_updates.append((proj_number, db_path_to_user_path(proj_db_location)))
         except Exception as e:
             logger.error(f"Error processing project {proj_number}: {e}")
-            continue
+
+    batches = batch_location_updates(location_updates)
+    fallback_updates = [] # projects the script did not handle, sent through per-project updates afterwards
+    for batch_idx, batch in enumerate(batches):
+        try:
+            script_result = clerk.update_locations_by_script(batch)
+        except (fmrest.exceptions.FMRestException, ValueError) as e:
+            # script missing, failing or timing out on the server; finish the remaining projects with per-project updates
+            logger.warning(f"Batch update via {LOCATION_UPDATE_SCRIPT} failed ({e}). Falling back to per-project updates.")
+            fallback_updates.extend(location_update for remaining_batch in batches[batch_idx:] for location_update in remaining_batch)
+            break
+
+        status.record_script_result(script_result)
+        for proj_number, user_location in unreported_location_updates(batch, script_result):
+            logger.warning(f"Project {proj_number} missing from {LOCATION_UPDATE_SCRIPT} result. Retrying with a per-project update.")
+            fallback_updates.append((proj_number, user_location))
+
+    if fallback_updates:
+        update_project_locations_concurrently(clerk, status, fallback_updates)
 
     logger.info("Update process completed. Status summary:")
     logger.info(str(status))